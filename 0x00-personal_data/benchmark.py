@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the personal_data redaction pipeline.
+Runs offline against a SQLite stand-in for get_db().
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, List
+
+from filtered_logger import (
+    PII_FIELDS, USER_FIELDS, RedactingFormatter, fetch_rows, filter_datum,
+    get_db, make_record,
+)
+
+
+BASELINE_PATH = "benchmark_baseline.json"
+
+
+def generate_rows(count: int, columns: List[str], seed: int = 0) -> List:
+    """
+    Generates rows shaped like user_data.csv for the given columns.
+    """
+    rng = random.Random(seed)
+    letters = string.ascii_letters
+
+    def word(size):
+        return ''.join(rng.choice(letters) for _ in range(size))
+
+    generators = {
+        'name': lambda: '{} {}'.format(word(6), word(8)),
+        'email': lambda: '{}@{}.com'.format(word(8), word(5)),
+        'phone': lambda: '({}) {}-{}'.format(
+            rng.randint(200, 999), rng.randint(200, 999),
+            rng.randint(1000, 9999)),
+        'ssn': lambda: '{}-{}-{}'.format(
+            rng.randint(100, 999), rng.randint(10, 99),
+            rng.randint(1000, 9999)),
+        'password': lambda: word(10),
+        'ip': lambda: ':'.join(
+            '{:x}'.format(rng.randint(0, 0xffff)) for _ in range(8)),
+        'last_login': lambda: '2019-11-14 {:02d}:{:02d}:{:02d}'.format(
+            rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)),
+        'user_agent': lambda: 'Mozilla/5.0 ({}; {}) {}/{}'.format(
+            word(7), word(5), word(6), rng.randint(40, 90)),
+    }
+    makers = [generators.get(c, lambda: word(12)) for c in columns]
+    return [tuple(make() for make in makers) for _ in range(count)]
+
+
+def schema(field_count: int):
+    """
+    Returns the columns and redacted fields for a field count: the
+    users columns followed by extra columns, every other one being PII.
+    """
+    columns = USER_FIELDS.split(',')
+    extra = ['extra_{}'.format(i) for i in range(field_count - len(columns))]
+    return columns + extra, list(PII_FIELDS) + extra[::2]
+
+
+def messages(columns: List[str], rows: List) -> List[str]:
+    """
+    Builds the `key=value;` log lines of the rows.
+    """
+    return [
+        '{};'.format('; '.join(
+            '{}={}'.format(c, v) for c, v in zip(columns, row)))
+        for row in rows
+    ]
+
+
+def measure(run: Callable[[], Iterable]) -> Dict[str, float]:
+    """
+    Runs a benchmark yielding once per record and reports throughput,
+    per-record latency percentiles and peak traced memory.
+    """
+    latencies = []
+    clock = time.perf_counter_ns
+    start = last = clock()
+    for _ in run():
+        now = clock()
+        latencies.append(now - last)
+        last = now
+    elapsed = (last - start) / 1e9
+    tracemalloc.start()
+    for _ in run():
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'lines_per_sec': count / elapsed if elapsed else 0.0,
+        'p50_us': latencies[count // 2] / 1e3 if count else 0.0,
+        'p99_us': latencies[min(count - 1, count * 99 // 100)] / 1e3
+        if count else 0.0,
+        'peak_kib': peak / 1024,
+    }
+
+
+def bench_filter_datum(fields: List[str], lines: List[str]) -> Callable:
+    """
+    Benchmark of filter_datum over log lines.
+    """
+    def run():
+        for line in lines:
+            yield filter_datum(fields, "***", line, ";")
+    return run
+
+
+def bench_format(fields: List[str], lines: List[str]) -> Callable:
+    """
+    Benchmark of RedactingFormatter.format over unredacted records.
+    """
+    formatter = RedactingFormatter(fields)
+
+    def run():
+        for line in lines:
+            record = logging.LogRecord(
+                "user_data", logging.INFO, None, None, line, None, None)
+            yield formatter.format(record)
+    return run
+
+
+def bench_export() -> Callable:
+    """
+    Benchmark of the main() export loop against the SQLite stand-in.
+    """
+    columns = USER_FIELDS.split(',')
+    formatter = RedactingFormatter(PII_FIELDS, redact_message_only=True)
+
+    def run():
+        connection = get_db()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT {} FROM users;".format(USER_FIELDS))
+            for row in fetch_rows(cursor):
+                yield formatter.format(make_record(columns, row, PII_FIELDS))
+        connection.close()
+    return run
+
+
+def create_users_db(path: str, rows: List):
+    """
+    Creates the users table of main.sql in a SQLite file.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE users (name VARCHAR(256), email VARCHAR(256), "
+        "phone VARCHAR(16), ssn VARCHAR(16), password VARCHAR(256), "
+        "ip VARCHAR(64), last_login TIMESTAMP, user_agent VARCHAR(512));")
+    connection.executemany(
+        "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows)
+    connection.commit()
+    connection.close()
+
+
+def run_suite(sizes: List[int], field_counts: List[int]) -> Dict:
+    """
+    Runs every benchmark and returns the results by name.
+    """
+    results = {}
+    tmp_dir = tempfile.mkdtemp(prefix="personal_data_bench_")
+    os.environ["PERSONAL_DATA_DB_BACKEND"] = "sqlite"
+    os.environ.pop("PERSONAL_DATA_DB_POOL_SIZE", None)
+    for size in sizes:
+        for field_count in field_counts:
+            columns, fields = schema(field_count)
+            lines = messages(columns, generate_rows(size, columns))
+            suffix = '{}x{}'.format(size, field_count)
+            results['filter_datum/' + suffix] = measure(
+                bench_filter_datum(fields, lines))
+            results['format/' + suffix] = measure(bench_format(fields, lines))
+        db_path = os.path.join(tmp_dir, 'users_{}.db'.format(size))
+        create_users_db(db_path, generate_rows(size, USER_FIELDS.split(',')))
+        os.environ["PERSONAL_DATA_DB_PATH"] = db_path
+        results['export/{}'.format(size)] = measure(bench_export())
+        os.remove(db_path)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def regressions(results: Dict, baseline: Dict, tolerance: float) -> List:
+    """
+    Returns the benchmarks slower than their baseline beyond tolerance.
+    """
+    slower = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+            slower.append(name)
+    return slower
+
+
+def main():
+    """
+    Runs the suite, prints a report and compares it with the baseline.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma separated row counts")
+    parser.add_argument("--fields", default="8,32",
+                        help="comma separated field counts (at least 8)")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="baseline file to compare with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed throughput drop before failing")
+    args = parser.parse_args()
+    sizes = [int(n) for n in args.sizes.split(',')]
+    field_counts = [max(8, int(n)) for n in args.fields.split(',')]
+    results = run_suite(sizes, field_counts)
+    print("{:<24} {:>12} {:>9} {:>9} {:>10}".format(
+        "benchmark", "lines/sec", "p50 us", "p99 us", "peak KiB"))
+    for name, r in results.items():
+        print("{:<24} {:>12.0f} {:>9.1f} {:>9.1f} {:>10.0f}".format(
+            name, r['lines_per_sec'], r['p50_us'], r['p99_us'],
+            r['peak_kib']))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.baseline))
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline, 'r') as f:
+        slower = regressions(results, json.load(f), args.tolerance)
+    for name in slower:
+        print("regression: {}".format(name), file=sys.stderr)
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
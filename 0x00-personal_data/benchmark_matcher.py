@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the regex and trie key matchers over growing field sets.
+"""
+
+import random
+import string
+import sys
+import time
+from typing import List
+
+from filtered_logger import RedactingFormatter, RedactionEngine
+
+
+def field_names(count: int, seed: int = 0) -> List[str]:
+    """
+    Generates count distinct field names.
+    """
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        size = rng.randint(3, 12)
+        names.add(''.join(rng.choice(string.ascii_lowercase + '_')
+                          for _ in range(size)))
+    return sorted(names)
+
+
+def log_lines(fields: List[str], count: int, seed: int = 0) -> List[str]:
+    """
+    Generates count lines of eight `key=value;` pairs, half of the
+    keys being redacted fields.
+    """
+    rng = random.Random(seed)
+    others = ["ip", "last_login", "user_agent", "id"]
+    lines = []
+    for _ in range(count):
+        keys = rng.sample(fields, min(4, len(fields))) + others
+        rng.shuffle(keys)
+        lines.append(''.join(
+            '{}={};'.format(key, rng.randint(0, 10 ** 9)) for key in keys))
+    return lines
+
+
+def lines_per_second(matcher: str, fields: List[str], lines: List[str]):
+    """
+    Returns the redaction throughput of a matcher.
+    """
+    redact = RedactionEngine(matcher=matcher).compile(
+        fields, RedactingFormatter.REDACTION, RedactingFormatter.SEPARATOR)
+    start = time.perf_counter()
+    for line in lines:
+        redact(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    """
+    Prints the throughput of both matchers and the crossover point.
+    """
+    sizes = [int(arg) for arg in sys.argv[1:]] or \
+        [5, 10, 25, 50, 100, 200, 400, 800]
+    crossover = None
+    print("{:>7} {:>14} {:>14}".format("fields", "regex l/s", "trie l/s"))
+    for size in sizes:
+        fields = field_names(size)
+        lines = log_lines(fields, 20000)
+        regex = lines_per_second('regex', fields, lines)
+        trie = lines_per_second('trie', fields, lines)
+        if crossover is None and trie > regex:
+            crossover = size
+        print("{:>7} {:>14.0f} {:>14.0f}".format(size, regex, trie))
+    print("crossover: {}".format(
+        "{} fields".format(crossover) if crossover else "not reached"))
+
+
+if __name__ == "__main__":
+    main()
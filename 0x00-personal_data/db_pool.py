@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Module providing pooled database connections for get_db().
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+from typing import Callable
+
+
+def connect_mysql():
+    """
+    Opens a MySQL connection configured from the environment.
+    """
+    import mysql.connector
+
+    return mysql.connector.connect(
+        host=os.getenv("PERSONAL_DATA_DB_HOST", "localhost"),
+        port=3306,
+        user=os.getenv("PERSONAL_DATA_DB_USERNAME", "root"),
+        password=os.getenv("PERSONAL_DATA_DB_PASSWORD", ""),
+        database=os.getenv("PERSONAL_DATA_DB_NAME", ""),
+    )
+
+
+def connect_sqlite():
+    """
+    Opens a SQLite connection on the PERSONAL_DATA_DB_PATH file.
+    """
+    db_path = os.getenv("PERSONAL_DATA_DB_PATH", "personal_data.db")
+    connection = sqlite3.connect(
+        db_path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+    )
+    return SQLiteConnection(connection)
+
+
+BACKENDS = {
+    'mysql': connect_mysql,
+    'sqlite': connect_sqlite,
+}
+
+
+class SQLiteCursor:
+    """
+    sqlite3 cursor accepting the %s placeholders used with MySQL
+    and usable as a context manager like mysql.connector cursors.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+    def execute(self, query: str, params: tuple = ()):
+        """
+        Executes a query written with %s placeholders.
+        """
+        return self._cursor.execute(query.replace('%s', '?'), params)
+
+
+class SQLiteConnection:
+    """
+    sqlite3 connection handing out SQLiteCursor objects.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._connection = connection
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+    def cursor(self) -> SQLiteCursor:
+        """
+        Returns a new cursor on the connection.
+        """
+        return SQLiteCursor(self._connection.cursor())
+
+
+class PooledConnection:
+    """
+    Connection checked out of a ConnectionPool.
+    close() hands the connection back to the pool.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', connection):
+        self._pool = pool
+        self._connection = connection
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+    def close(self):
+        """
+        Returns the connection to its pool.
+        """
+        if self._connection is not None:
+            self._pool.release(self._connection)
+            self._connection = None
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections.
+    """
+
+    def __init__(
+            self, connect: Callable, size: int = 5, timeout: float = 30.0,
+            ):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def checkout(self) -> PooledConnection:
+        """
+        Returns a healthy connection, waiting at most timeout seconds
+        for one to be released when the pool is exhausted.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(
+                "no database connection available after {}s".format(
+                    self.timeout))
+        try:
+            return PooledConnection(self, self._healthy_connection())
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Puts a connection back into the pool.
+        """
+        self._idle.put(connection)
+        self._slots.release()
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _healthy_connection(self):
+        """
+        Reuses an idle connection that answers a ping, else opens one.
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if self._ping(connection):
+                return connection
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _ping(connection) -> bool:
+        """
+        Checks that a connection still answers queries.
+        """
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connect():
+    """
+    Returns a connection on the PERSONAL_DATA_DB_BACKEND backend,
+    checked out of a pool when PERSONAL_DATA_DB_POOL_SIZE is set.
+    """
+    backend = os.getenv("PERSONAL_DATA_DB_BACKEND", "mysql")
+    size = int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", "0"))
+    if size <= 0:
+        return BACKENDS[backend]()
+    timeout = float(os.getenv("PERSONAL_DATA_DB_POOL_TIMEOUT", "30"))
+    key = (os.getpid(), backend, size, timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(BACKENDS[backend], size, timeout)
+            _pools[key] = pool
+    return pool.checkout()
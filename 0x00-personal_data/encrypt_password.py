@@ -3,9 +3,220 @@
 Module for password encryption and validation.
 """
 
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+from typing import Iterable, Iterator, Optional, Tuple
+
 import bcrypt
 
 
+DEFAULT_ROUNDS = 12
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+# Lowest cost calibration may pick or hash_password may use, so a fast
+# host or a tiny target never downgrades the stored hashes
+SECURE_ROUNDS = DEFAULT_ROUNDS
+# Persisted cost of each settings file, read once per process
+_rounds_cache = {}
+
+
+def rounds_path() -> str:
+    """
+    Return the file storing the calibrated bcrypt cost.
+    """
+    return os.getenv("PERSONAL_DATA_BCRYPT_CONFIG", ".bcrypt_rounds.json")
+
+
+def load_rounds(path: str = None) -> Optional[int]:
+    """
+    Read the persisted bcrypt cost.
+
+    Args:
+        path (str): The settings file, rounds_path() by default.
+
+    Returns:
+        Optional[int]: The persisted cost, None if none was saved.
+    """
+    path = path or rounds_path()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return int(json.load(f)['rounds'])
+
+
+def save_rounds(rounds: int, path: str = None):
+    """
+    Persist a bcrypt cost so hash_password uses it from now on.
+
+    Args:
+        rounds (int): The bcrypt cost to persist.
+        path (str): The settings file, rounds_path() by default.
+    """
+    path = path or rounds_path()
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump({'rounds': rounds}, f)
+    os.replace(tmp_path, path)
+    _rounds_cache[path] = rounds
+
+
+def target_rounds() -> int:
+    """
+    Return the bcrypt cost new hashes should use.
+
+    Returns:
+        int: The persisted cost, or bcrypt's default one, and never
+            less than SECURE_ROUNDS.
+    """
+    path = rounds_path()
+    if path not in _rounds_cache:
+        _rounds_cache[path] = load_rounds(path)
+    rounds = _rounds_cache[path]
+    return DEFAULT_ROUNDS if rounds is None else max(SECURE_ROUNDS, rounds)
+
+
+def calibrate_rounds(
+        target_ms: float = 250.0, samples: int = 3,
+        min_rounds: int = SECURE_ROUNDS,
+        ) -> int:
+    """
+    Pick the bcrypt cost closest to a target hashing time on this host.
+
+    Args:
+        target_ms (float): The wanted time of one hash or check, in ms.
+        samples (int): Number of timed hashes at the reference cost.
+        min_rounds (int): The lowest cost that may be picked.
+
+    Returns:
+        int: The bcrypt cost whose estimated time is closest to target_ms.
+    """
+    reference = 8
+    salt = bcrypt.gensalt(rounds=reference)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hashpw(b'calibration', salt)
+        timings.append((time.perf_counter() - start) * 1000)
+    # Each extra round doubles the work done by bcrypt
+    reference_ms = sorted(timings)[len(timings) // 2]
+    return min(
+        range(max(MIN_ROUNDS, min_rounds), MAX_ROUNDS + 1),
+        key=lambda r: abs(reference_ms * 2 ** (r - reference) - target_ms),
+    )
+
+
+class VerifiedCache:
+    """
+    Bounded, TTL based cache of recent successful password checks.
+
+    Entries are keyed by the stored hash and an HMAC of the candidate
+    password under a per-process random key; plaintexts are never kept.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, hashed_password: bytes, password: str) -> tuple:
+        """
+        Build the cache key of a (hashed_password, password) pair.
+        """
+        digest = hmac.new(
+            self._secret, password.encode('utf-8'), hashlib.sha256).digest()
+        return hashed_password, digest
+
+    def get(self, hashed_password: bytes, password: str) -> bool:
+        """
+        Tell whether the pair was successfully checked within the TTL.
+        """
+        key = self._key(hashed_password, password)
+        now = time.monotonic()
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is not None and expires > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if expires is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, hashed_password: bytes, password: str):
+        """
+        Record a successful check of the pair.
+        """
+        key = self._key(hashed_password, password)
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, hashed_password: bytes = None):
+        """
+        Forget the checks of one stored hash, or every check.
+        """
+        with self._lock:
+            if hashed_password is None:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] == hashed_password]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        """
+        Return the size and hit/miss counters of the cache.
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_verify_cache = None
+
+
+def enable_verify_cache(
+        maxsize: int = 1024, ttl: float = 300.0,
+        ) -> VerifiedCache:
+    """
+    Make is_valid remember successful checks for ttl seconds.
+
+    Args:
+        maxsize (int): Maximum number of remembered checks.
+        ttl (float): Seconds a successful check is remembered.
+
+    Returns:
+        VerifiedCache: The cache, for invalidation and stats.
+    """
+    global _verify_cache
+    _verify_cache = VerifiedCache(maxsize, ttl)
+    return _verify_cache
+
+
+def disable_verify_cache():
+    """
+    Make is_valid run bcrypt on every call again.
+    """
+    global _verify_cache
+    _verify_cache = None
+
+
 def hash_password(password: str) -> bytes:
     """
     Hash a password using bcrypt with salt.
@@ -16,8 +227,8 @@ def hash_password(password: str) -> bytes:
     Returns:
         bytes: The salted, hashed password.
     """
-    # Generate a salt and hash the password
-    salt = bcrypt.gensalt()
+    # Generate a salt at the configured cost and hash the password
+    salt = bcrypt.gensalt(rounds=target_rounds())
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
 
     return hashed_password
@@ -34,5 +245,100 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     Returns:
         bool: True if the password is correct, False otherwise.
     """
+    cache = _verify_cache
+    if cache is not None and cache.get(hashed_password, password):
+        return True
     # Use bcrypt to check if the provided password matches the hashed one
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+    valid = bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+    if valid and cache is not None:
+        cache.add(hashed_password, password)
+    return valid
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """
+    Return the bcrypt cost a hash was made with.
+
+    Args:
+        hashed_password (bytes): A bcrypt hash such as b'$2b$12$...'.
+
+    Returns:
+        int: The cost stored in the hash.
+    """
+    return int(hashed_password.split(b'$')[2])
+
+
+def verify_password(
+        hashed_password: bytes, password: str,
+        ) -> Tuple[bool, bool]:
+    """
+    Check a password like is_valid and tell whether its hash is stale.
+
+    Args:
+        hashed_password (bytes): The stored hashed password.
+        password (str): The password string to check.
+
+    Returns:
+        Tuple[bool, bool]: Whether the password is correct, and whether
+            the hash cost differs from target_rounds(), in which case
+            the caller should store hash_password(password) instead.
+    """
+    valid = is_valid(hashed_password, password)
+    needs_rehash = valid and hash_rounds(hashed_password) != target_rounds()
+    return valid, needs_rehash
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """
+    Check a (hashed_password, password) pair with is_valid.
+    """
+    return is_valid(*pair)
+
+
+def hash_passwords(
+        passwords: Iterable[str], workers: int = None, chunksize: int = 8,
+        ) -> Iterator[bytes]:
+    """
+    Hash many passwords in parallel using a pool of worker processes.
+
+    Args:
+        passwords (Iterable[str]): The password strings to be hashed.
+        workers (int): Number of worker processes, one per core by default.
+        chunksize (int): Number of passwords handed to a worker at once.
+
+    Returns:
+        Iterator[bytes]: The salted, hashed passwords, in input order.
+    """
+    # bcrypt is CPU bound, so spread the work over one process per core
+    with Pool(workers or os.cpu_count()) as pool:
+        for hashed_password in pool.imap(hash_password, passwords, chunksize):
+            yield hashed_password
+
+
+def verify_many(
+        pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+        chunksize: int = 8,
+        ) -> Iterator[bool]:
+    """
+    Check many passwords against their hashes in parallel.
+
+    Args:
+        pairs (Iterable[Tuple[bytes, str]]): (hashed_password, password)
+            pairs, as accepted by is_valid.
+        workers (int): Number of worker processes, one per core by default.
+        chunksize (int): Number of pairs handed to a worker at once.
+
+    Returns:
+        Iterator[bool]: Whether each password is correct, in input order.
+    """
+    with Pool(workers or os.cpu_count()) as pool:
+        for valid in pool.imap(_is_valid_pair, pairs, chunksize):
+            yield valid
+
+
+if __name__ == "__main__":
+    # Calibrate the cost for this host and persist it
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 250.0
+    cost = calibrate_rounds(target)
+    save_rounds(cost)
+    print("bcrypt rounds {} saved to {}".format(cost, rounds_path()))
@@ -3,11 +3,25 @@
 Module for securely connecting to the database and filtering user data.
 """
 
+import json
 import os
 import re
+import sys
+import shutil
+import atexit
 import logging
-import mysql.connector
-from typing import List
+import tempfile
+import threading
+import time
+import db_pool
+from key_matcher import TrieMatcher
+from log_queue import BatchingListener, BoundedQueueHandler
+from log_sampling import SamplingFilter
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache, partial
+from multiprocessing import Pool
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
 
 
 patterns = {
@@ -15,6 +29,71 @@ patterns = {
     'replace': lambda x: r'\g<field>={}'.format(x),
 }
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+USER_FIELDS = "name,email,phone,ssn,password,ip,last_login,user_agent"
+
+
+TRIE_MIN_FIELDS = 40
+
+
+class RedactionEngine:
+    """
+    Compiles redaction patterns once and keeps them in a bounded LRU.
+    The matcher is the filter_datum regex, a TrieMatcher, or 'auto'
+    to use the trie from TRIE_MIN_FIELDS fields on.
+    """
+
+    def __init__(self, maxsize: int = 128, matcher: str = 'regex'):
+        if matcher not in ('regex', 'trie', 'auto'):
+            raise ValueError("matcher must be 'regex', 'trie' or 'auto'")
+        self.maxsize = maxsize
+        self.matcher = matcher
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compile(
+            self, fields: List[str], redaction: str, separator: str,
+            ) -> Callable[[str], str]:
+        """
+        Returns a callable redacting a message for the given settings.
+        """
+        key = (tuple(fields), separator, redaction)
+        with self._lock:
+            redactor = self._cache.get(key)
+            if redactor is not None:
+                self._cache.move_to_end(key)
+                return redactor
+        if self._use_trie(key[0]):
+            matcher = TrieMatcher(key[0], separator)
+            redactor = partial(matcher.sub, redaction)
+        else:
+            extract, replace = (patterns["extract"], patterns["replace"])
+            pattern = re.compile(extract(key[0], separator))
+            redactor = partial(pattern.sub, replace(redaction))
+        with self._lock:
+            self._cache[key] = redactor
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return redactor
+
+    def _use_trie(self, fields: Tuple[str, ...]) -> bool:
+        """
+        Tells whether the trie matcher should be used for the fields.
+        """
+        if self.matcher == 'auto':
+            return len(fields) >= TRIE_MIN_FIELDS
+        return self.matcher == 'trie'
+
+    def redact(
+            self, fields: List[str], redaction: str, message: str,
+            separator: str,
+            ) -> str:
+        """
+        Redacts the values of the given fields in a message.
+        """
+        return self.compile(fields, redaction, separator)(message)
+
+
+redaction_engine = RedactionEngine(matcher='auto')
 
 
 def filter_datum(
@@ -23,62 +102,348 @@ def filter_datum(
     """
     Filters a log line.
     """
-    extract, replace = (patterns["extract"], patterns["replace"])
-    return re.sub(extract(fields, separator), replace(redaction), message)
+    return redaction_engine.redact(fields, redaction, message, separator)
 
 
-def get_logger() -> logging.Logger:
+def get_logger(
+        async_mode: bool = False, queue_size: int = 10000,
+        overflow: str = 'block', structured: bool = False,
+        redact_once: bool = False, sampling: SamplingFilter = None,
+        ) -> logging.Logger:
     """
     Creates a new logger for user data.
+    A structured logger writes one redacted JSON object per line.
+    With redact_once, records are redacted by a logger filter before
+    reaching the handlers, which then skip redaction.
+    In async mode records go through a bounded queue to a background
+    listener that formats, redacts and writes them in batches; the
+    queue handler exposes its counters through stats().
+    The summary of the last sampling window is logged at exit.
     """
     logger = logging.getLogger("user_data")
     stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
+    if structured:
+        formatter = JsonRedactingFormatter(PII_FIELDS)
+    else:
+        formatter = RedactingFormatter(PII_FIELDS, redact_message_only=True)
+    stream_handler.setFormatter(formatter)
     logger.setLevel(logging.INFO)
     logger.propagate = False
-    logger.addHandler(stream_handler)
+    if sampling is not None:
+        logger.addFilter(sampling)
+    if redact_once:
+        logger.addFilter(RedactingFilter(PII_FIELDS))
+    if async_mode:
+        queue_handler = BoundedQueueHandler(queue_size, overflow)
+        queue_handler.listener = BatchingListener(
+            queue_handler.queue, [stream_handler])
+        queue_handler.listener.start()
+        atexit.register(queue_handler.listener.stop)
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(stream_handler)
+    if sampling is not None:
+        # Registered last so it runs first at exit, while the listener
+        # still writes records
+        atexit.register(sampling.flush_summary, logger.name)
     return logger
 
 
-def get_db() -> mysql.connector.connection.MySQLConnection:
+def get_db():
     """
     Creates a connector to a database.
+    The backend and pooling are configured through the
+    PERSONAL_DATA_DB_* environment variables (see db_pool).
     """
-    db_host = os.getenv("PERSONAL_DATA_DB_HOST", "localhost")
-    db_name = os.getenv("PERSONAL_DATA_DB_NAME", "")
-    db_user = os.getenv("PERSONAL_DATA_DB_USERNAME", "root")
-    db_pwd = os.getenv("PERSONAL_DATA_DB_PASSWORD", "")
-    connection = mysql.connector.connect(
-        host=db_host,
-        port=3306,
-        user=db_user,
-        password=db_pwd,
-        database=db_name,
-    )
-    return connection
+    return db_pool.connect()
+
+
+def fetch_rows(cursor, batch_size: int = 1000) -> Iterator[tuple]:
+    """
+    Streams the rows of an executed query in batches of batch_size.
+    """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+@lru_cache(maxsize=128)
+def pii_positions(
+        columns: Tuple[str, ...], fields: Tuple[str, ...],
+        ) -> Tuple[int, ...]:
+    """
+    Returns the positions of the PII fields among the columns.
+    """
+    return tuple(i for i, column in enumerate(columns) if column in fields)
+
+
+def redact_row(
+        columns: Sequence[str], row: Sequence,
+        fields: Sequence[str] = PII_FIELDS, redaction: str = "***",
+        ) -> list:
+    """
+    Redacts the values of the PII columns of a row by position.
+    Rows shorter than the columns, like blank CSV lines, only have
+    the values they hold redacted.
+    """
+    values = list(row)
+    for i in pii_positions(tuple(columns), tuple(fields)):
+        if i >= len(values):
+            break
+        values[i] = redaction
+    return values
+
+
+def make_record(
+        columns: List[str], row: tuple, fields: Sequence[str] = None,
+        structured: bool = False,
+        ) -> logging.LogRecord:
+    """
+    Builds the user_data LogRecord for a row of the users table.
+    When fields are given, their values are redacted by column
+    position and the record is marked so formatters skip the regex.
+    A structured record carries a column -> value dict as its message.
+    """
+    if fields is not None:
+        row = redact_row(columns, row, fields, RedactingFormatter.REDACTION)
+    if structured:
+        msg = dict(zip(columns, row))
+    else:
+        record = map(
+            lambda x: '{}={}'.format(x[0], x[1]),
+            zip(columns, row),
+        )
+        msg = '{};'.format('; '.join(list(record)))
+    args = ("user_data", logging.INFO, None, None, msg, None, None)
+    log_record = logging.LogRecord(*args)
+    log_record.pii_redacted = fields is not None
+    return log_record
+
+
+def last_login_partitions(connection, count: int) -> List[Tuple]:
+    """
+    Splits the users table into count ranges of last_login.
+    Each range is a (low, high) pair, high being None for the last one;
+    a trailing (None, None) range holds the rows without a last_login.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MIN(last_login), MAX(last_login) FROM users;")
+        low, high = cursor.fetchone()
+    if isinstance(low, str):
+        low, high = datetime.fromisoformat(low), datetime.fromisoformat(high)
+    partitions = []
+    if low is not None:
+        step = (high - low) / count
+        bounds = [low + step * i for i in range(count)]
+        if step:
+            partitions = list(zip(bounds, bounds[1:] + [None]))
+        else:
+            partitions = [(low, None)]
+    partitions.append((None, None))
+    return partitions
+
+
+def partition_query(fields: str, low, high) -> Tuple[str, tuple]:
+    """
+    Returns the query and parameters selecting a last_login range.
+    """
+    query = "SELECT {} FROM users WHERE ".format(fields)
+    if low is None:
+        return query + "last_login IS NULL;", ()
+    if high is None:
+        return query + "last_login >= %s;", (low,)
+    return query + "last_login >= %s AND last_login < %s;", (low, high)
+
+
+def export_partition(job: Tuple) -> Tuple[str, int]:
+    """
+    Formats and redacts one partition of the users table into a file.
+    """
+    path, low, high, batch_size, structured = job
+    columns = USER_FIELDS.split(',')
+    query, params = partition_query(USER_FIELDS, low, high)
+    if structured:
+        formatter = JsonRedactingFormatter(PII_FIELDS)
+    else:
+        formatter = RedactingFormatter(PII_FIELDS, redact_message_only=True)
+    count = 0
+    connection = get_db()
+    try:
+        with connection.cursor() as cursor, open(path, 'w') as f:
+            cursor.execute(query, params)
+            for row in fetch_rows(cursor, batch_size):
+                record = make_record(columns, row, PII_FIELDS, structured)
+                f.write(formatter.format(record) + '\n')
+                count += 1
+    finally:
+        connection.close()
+    return path, count
+
+
+def export_parallel(
+        workers: int = None, output_prefix: str = None,
+        batch_size: int = 1000, structured: bool = False,
+        ) -> int:
+    """
+    Exports the users table with one process per last_login partition.
+    Partitions are written to output_prefix.<n>.log shards, or merged
+    in order to stderr when no prefix is given; structured writes JSON
+    lines instead of text.
+    Returns the number of exported rows.
+    """
+    workers = workers or os.cpu_count() or 1
+    connection = get_db()
+    try:
+        partitions = last_login_partitions(connection, workers)
+    finally:
+        connection.close()
+    tmp_dir = None
+    if output_prefix is None:
+        tmp_dir = tempfile.mkdtemp(prefix="user_data_")
+        prefix = os.path.join(tmp_dir, "part")
+    else:
+        prefix = output_prefix
+    jobs = [
+        ('{}.{}.log'.format(prefix, i), low, high, batch_size, structured)
+        for i, (low, high) in enumerate(partitions)
+    ]
+    total = 0
+    try:
+        with Pool(min(workers, len(jobs))) as pool:
+            for path, count in pool.imap(export_partition, jobs):
+                total += count
+                if tmp_dir is not None:
+                    with open(path, 'r') as f:
+                        shutil.copyfileobj(f, sys.stderr)
+                    os.remove(path)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return total
+
+
+def load_checkpoint(path: str) -> Optional[dict]:
+    """
+    Reads the watermark of the last successful incremental export.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, last_login):
+    """
+    Atomically replaces the watermark of the incremental export.
+    Only the last_login timestamp is stored, never a row value.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_login': str(last_login)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_lossy(logger: logging.Logger) -> bool:
+    """
+    Tells whether a logger may drop records: through a sampling filter,
+    or a queue handler whose overflow policy is not 'block'.
+    """
+    filters = list(logger.filters)
+    for handler in logger.handlers:
+        filters.extend(handler.filters)
+        if isinstance(handler, BoundedQueueHandler) and \
+                handler.overflow != 'block':
+            return True
+    return any(isinstance(f, SamplingFilter) for f in filters)
+
+
+def export_incremental(
+        logger: logging.Logger, connection, checkpoint_path: str,
+        batch_size: int = 1000, structured: bool = False,
+        ) -> int:
+    """
+    Logs the users whose last_login is at or past the checkpoint
+    watermark, then advances the checkpoint once the logger's handlers
+    are flushed. Rows without a last_login are not exported.
+    Delivery is at least once: rows sharing the watermark timestamp are
+    logged again by the next run, so none that arrive later is missed.
+    The logger must not drop records, or the checkpoint would move past
+    rows that were never written.
+    Returns the number of exported rows.
+    """
+    if is_lossy(logger):
+        raise ValueError("the incremental export needs a logger that "
+                         "does not sample or drop records")
+    columns = USER_FIELDS.split(',')
+    login_idx = columns.index('last_login')
+    query = "SELECT {} FROM users WHERE last_login IS NOT NULL".format(
+        USER_FIELDS)
+    params = ()
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        query += " AND last_login >= %s"
+        params = (checkpoint['last_login'],)
+    query += " ORDER BY last_login;"
+    count = 0
+    last_row = None
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        for row in fetch_rows(cursor, batch_size):
+            logger.handle(make_record(columns, row, PII_FIELDS, structured))
+            last_row = row
+            count += 1
+    if last_row is not None:
+        for handler in logger.handlers:
+            handler.flush()
+        save_checkpoint(checkpoint_path, last_row[login_idx])
+    return count
 
 
 def main():
     """
     Logs the information about user records in a table.
     """
-    fields = "name,email,phone,ssn,password,ip,last_login,user_agent"
-    columns = fields.split(',')
-    query = "SELECT {} FROM users;".format(fields)
-    info_logger = get_logger()
+    batch_size = int(os.getenv("PERSONAL_DATA_EXPORT_BATCH_SIZE", "1000"))
+    workers = int(os.getenv("PERSONAL_DATA_EXPORT_WORKERS", "1"))
+    structured = os.getenv("PERSONAL_DATA_LOG_FORMAT", "text") == "json"
+    checkpoint_path = os.getenv("PERSONAL_DATA_EXPORT_CHECKPOINT")
+    overflow = os.getenv("PERSONAL_DATA_LOG_OVERFLOW", "block")
+    if checkpoint_path and workers > 1:
+        raise ValueError("PERSONAL_DATA_EXPORT_CHECKPOINT cannot be used "
+                         "with several PERSONAL_DATA_EXPORT_WORKERS")
+    if checkpoint_path and overflow != 'block':
+        raise ValueError("PERSONAL_DATA_EXPORT_CHECKPOINT needs "
+                         "PERSONAL_DATA_LOG_OVERFLOW=block")
+    if workers > 1:
+        output_prefix = os.getenv("PERSONAL_DATA_EXPORT_PREFIX")
+        export_parallel(workers, output_prefix, batch_size, structured)
+        return
+    info_logger = get_logger(
+        async_mode=os.getenv("PERSONAL_DATA_LOG_ASYNC", "0") == "1",
+        queue_size=int(os.getenv("PERSONAL_DATA_LOG_QUEUE_SIZE", "10000")),
+        overflow=overflow,
+        structured=structured,
+    )
     connection = get_db()
+    if checkpoint_path:
+        export_incremental(
+            info_logger, connection, checkpoint_path, batch_size,
+            structured)
+        connection.close()
+        return
+    columns = USER_FIELDS.split(',')
+    query = "SELECT {} FROM users;".format(USER_FIELDS)
     with connection.cursor() as cursor:
         cursor.execute(query)
-        rows = cursor.fetchall()
-        for row in rows:
-            record = map(
-                lambda x: '{}={}'.format(x[0], x[1]),
-                zip(columns, row),
-            )
-            msg = '{};'.format('; '.join(list(record)))
-            args = ("user_data", logging.INFO, None, None, msg, None, None)
-            log_record = logging.LogRecord(*args)
-            info_logger.handle(log_record)
+        for row in fetch_rows(cursor, batch_size):
+            record = make_record(columns, row, PII_FIELDS, structured)
+            info_logger.handle(record)
+    connection.close()
 
 
 class RedactingFormatter(logging.Formatter):
@@ -91,18 +456,148 @@ class RedactingFormatter(logging.Formatter):
     FORMAT_FIELDS = ('name', 'levelname', 'asctime', 'message')
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(
+            self, fields: List[str], engine: RedactionEngine = None,
+            redact_message_only: bool = False,
+            ):
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.redact_message_only = redact_message_only
+        engine = engine or redaction_engine
+        self._redact = engine.compile(fields, self.REDACTION, self.SEPARATOR)
+        self._markers = tuple('{}='.format(field) for field in fields)
+        self._asctime_second = None
+        self._asctime_prefix = None
+
+    def formatTime(self, record: logging.LogRecord, datefmt=None) -> str:
+        """
+        formats the creation time, reusing the rendering for each second.
+        """
+        if not self.redact_message_only or datefmt is not None:
+            return super(RedactingFormatter, self).formatTime(record, datefmt)
+        second = int(record.created)
+        if second != self._asctime_second:
+            ct = self.converter(record.created)
+            self._asctime_prefix = time.strftime(self.default_time_format, ct)
+            self._asctime_second = second
+        return self.default_msec_format % (self._asctime_prefix, record.msecs)
+
+    def redact_message(self, message: str) -> str:
+        """
+        redacts a message, skipping the regex when no field is present.
+        """
+        if not any(marker in message for marker in self._markers):
+            return message
+        return self._redact(message)
 
     def format(self, record: logging.LogRecord) -> str:
         """
         formats a LogRecord.
         """
+        if self.redact_message_only or isinstance(record.msg, dict) or \
+                getattr(record, 'pii_redacted', False):
+            return self._format_message_only(record)
         msg = super(RedactingFormatter, self).format(record)
-        txt = filter_datum(self.fields, self.REDACTION, msg, self.SEPARATOR)
+        txt = self._redact(msg)
         return txt
 
+    def _format_message_only(self, record: logging.LogRecord) -> str:
+        """
+        formats a LogRecord, redacting only its message payload
+        unless the record is already marked as redacted.
+        """
+        if isinstance(record.msg, dict):
+            columns = tuple(record.msg)
+            row = redact_row(
+                columns, record.msg.values(), self.fields, self.REDACTION)
+            message = '{};'.format('; '.join(
+                '{}={}'.format(k, v) for k, v in zip(columns, row)))
+        elif getattr(record, 'pii_redacted', False):
+            message = record.getMessage()
+        else:
+            message = self.redact_message(record.getMessage())
+        record.message = message
+        record.asctime = self.formatTime(record, self.datefmt)
+        txt = self.formatMessage(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            txt = '{}\n{}'.format(txt, record.exc_text)
+        if record.stack_info:
+            txt = '{}\n{}'.format(txt, self.formatStack(record.stack_info))
+        return txt
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Filter redacting a record's message once and marking the record
+    as redacted, so the formatters of every handler skip redaction.
+    """
+
+    def __init__(self, fields: List[str], engine: RedactionEngine = None):
+        super(RedactingFilter, self).__init__()
+        self.fields = fields
+        engine = engine or redaction_engine
+        self._redact = engine.compile(
+            fields, RedactingFormatter.REDACTION,
+            RedactingFormatter.SEPARATOR)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        redacts a LogRecord in place.
+        """
+        if getattr(record, 'pii_redacted', False):
+            return True
+        if isinstance(record.msg, dict):
+            values = redact_row(
+                tuple(record.msg), record.msg.values(), self.fields,
+                RedactingFormatter.REDACTION)
+            record.msg = dict(zip(record.msg, values))
+        else:
+            record.msg = self._redact(record.getMessage())
+            record.args = None
+        record.pii_redacted = True
+        return True
+
+
+class JsonRedactingFormatter(logging.Formatter):
+    """
+    Formatter writing records as redacted JSON objects, one per line.
+    Dict messages are redacted by key without any regex pass.
+    """
+
+    REDACTION = RedactingFormatter.REDACTION
+    ENCODER = json.JSONEncoder(
+        ensure_ascii=False, separators=(',', ':'), default=str)
+
+    def __init__(self, fields: List[str], engine: RedactionEngine = None):
+        super(JsonRedactingFormatter, self).__init__()
+        self.fields = frozenset(fields)
+        engine = engine or redaction_engine
+        self._redact = engine.compile(
+            fields, self.REDACTION, RedactingFormatter.SEPARATOR)
+
+    def format(self, record: logging.LogRecord) -> str:
+        """
+        formats a LogRecord as a JSON object.
+        """
+        data = record.msg
+        redacted = getattr(record, 'pii_redacted', False)
+        if not isinstance(data, dict):
+            message = record.getMessage()
+            data = {'message': message if redacted else self._redact(message)}
+        elif not redacted:
+            data = {
+                k: self.REDACTION if k in self.fields else v
+                for k, v in data.items()
+            }
+        return self.ENCODER.encode({
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'data': data,
+        })
+
 
 if __name__ == "__main__":
     main()
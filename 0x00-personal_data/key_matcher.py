@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Module for matching field keys with a trie instead of a regex.
+"""
+
+from typing import List, Optional
+
+
+_END = None
+
+
+class TrieMatcher:
+    """
+    Redacts `field=value` pairs like the filter_datum regex, using a
+    trie of the reversed field names.
+    Each '=' is located with str.find and the trie is walked backwards
+    from it, so a line is scanned once whatever the number of fields.
+    Field names are matched literally.
+    """
+
+    def __init__(self, fields: List[str], separator: str):
+        self._root = {}
+        for field in fields:
+            node = self._root
+            for char in reversed(field):
+                node = node.setdefault(char, {})
+            node[_END] = True
+        self._stops = tuple(set(separator))
+
+    def _key_before(self, message: str, eq: int, pos: int) -> Optional[int]:
+        """
+        Returns the start of the longest field ending right before the
+        '=' at eq and starting at or after pos, None if there is none.
+        """
+        node = self._root
+        start = eq if _END in node else None
+        i = eq - 1
+        while i >= pos:
+            node = node.get(message[i])
+            if node is None:
+                break
+            if _END in node:
+                start = i
+            i -= 1
+        return start
+
+    def _value_end(self, message: str, pos: int) -> int:
+        """
+        Returns the index of the first separator character after pos.
+        """
+        end = len(message)
+        for stop in self._stops:
+            i = message.find(stop, pos, end)
+            if i != -1:
+                end = i
+        return end
+
+    def sub(self, redaction: str, message: str) -> str:
+        """
+        Replaces the value of every matched field with redaction.
+        """
+        parts = []
+        pos = 0
+        eq = message.find('=')
+        while eq != -1:
+            if self._key_before(message, eq, pos) is None:
+                eq = message.find('=', eq + 1)
+                continue
+            parts.append(message[pos:eq + 1])
+            parts.append(redaction)
+            pos = self._value_end(message, eq + 1)
+            eq = message.find('=', pos)
+        if not parts:
+            return message
+        parts.append(message[pos:])
+        return ''.join(parts)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Module for handing log records to a background thread through a
+bounded queue.
+"""
+
+import logging
+import queue
+import threading
+from typing import Dict, List
+
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'sample')
+
+
+class BoundedQueueHandler(logging.Handler):
+    """
+    Handler putting records on a bounded queue without formatting them.
+    When the queue is full, records are handled per the overflow policy:
+    block until there is room, drop the oldest queued record, or keep
+    only one in every sample_rate overflowing records, dropping the
+    oldest queued record to make room for it.
+    """
+
+    def __init__(
+            self, maxsize: int = 10000, overflow: str = 'block',
+            sample_rate: int = 10,
+            ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                ", ".join(OVERFLOW_POLICIES)))
+        super(BoundedQueueHandler, self).__init__()
+        self.queue = queue.Queue(maxsize)
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.listener = None
+        self.enqueued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._overflowed = 0
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of records waiting in the queue.
+        """
+        return self.queue.qsize()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the queue counters.
+        """
+        return {
+            'depth': self.depth,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+        }
+
+    def flush(self):
+        """
+        Waits until the listener has written every queued record.
+        """
+        if self.listener is not None:
+            self.queue.join()
+
+    def emit(self, record: logging.LogRecord):
+        """
+        Queues a record, applying the overflow policy when full.
+        """
+        try:
+            if self.overflow == 'block':
+                self.queue.put(record)
+                self.enqueued += 1
+            else:
+                self._put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+    def _put_nowait(self, record: logging.LogRecord):
+        """
+        Queues a record without waiting for the listener.
+        """
+        try:
+            self.queue.put_nowait(record)
+            self.enqueued += 1
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'sample':
+            self._overflowed += 1
+            if self._overflowed % self.sample_rate:
+                self.sampled_out += 1
+                return
+        # Make room for the record by dropping the oldest queued ones
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                self.enqueued += 1
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class BatchingListener:
+    """
+    Background thread formatting queued records and writing them to
+    its handlers in batches.
+    """
+
+    _sentinel = None
+
+    def __init__(
+            self, records: queue.Queue, handlers: List[logging.Handler],
+            batch_size: int = 512,
+            ):
+        self.queue = records
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the listener thread.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes the remaining records and stops the listener thread.
+        """
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        """
+        Drains the queue in batches until the sentinel is received.
+        """
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._sentinel
+            if stop:
+                batch.pop()
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+            if stop:
+                return
+
+    def _write(self, batch: List[logging.LogRecord]):
+        """
+        Formats a batch and writes it with one call per handler.
+        """
+        for handler in self.handlers:
+            records = [
+                r for r in batch
+                if r.levelno >= handler.level and handler.filter(r)
+            ]
+            if not isinstance(handler, logging.StreamHandler):
+                for record in records:
+                    handler.handle(record)
+                continue
+            try:
+                lines = [handler.format(r) for r in records]
+                if not lines:
+                    continue
+                terminator = handler.terminator
+                with handler.lock:
+                    handler.stream.write(
+                        terminator.join(lines) + terminator)
+                    handler.flush()
+            except Exception:
+                handler.handleError(records[0])
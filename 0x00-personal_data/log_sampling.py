@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Module for sampling and rate-limiting log records.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Hashable
+
+
+class TokenBucket:
+    """
+    Token bucket allowing rate events per second with bursts of burst.
+    """
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        """
+        Takes a token if one is available.
+        """
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def full(self, now: float) -> bool:
+        """
+        Tells whether the bucket would hold burst tokens at now.
+        """
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Filter capping the records let through for each key.
+    A record passes when its key's token bucket has a token (if rate
+    is set) and it is among the first first_n records of the key in
+    the current window, or one in every every_m records after that.
+    Suppressed records are counted and reported on a summary line
+    logged at the end of every summary_interval seconds window.
+    """
+
+    def __init__(
+            self, rate: float = None, burst: float = None,
+            first_n: int = None, every_m: int = 1,
+            key: Callable[[logging.LogRecord], Hashable] = None,
+            summary_interval: float = 60.0,
+            clock: Callable[[], float] = time.monotonic,
+            ):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        # A bucket holding less than one token would never let a
+        # record through, so slow rates still allow single records
+        if burst is None and rate is not None:
+            burst = max(1, rate)
+        self.burst = burst
+        self.first_n = first_n
+        self.every_m = every_m
+        self.key = key or (lambda record: record.name)
+        self.summary_interval = summary_interval
+        self.clock = clock
+        self.passed = 0
+        self.suppressed = 0
+        self._buckets = {}
+        self._seen = {}
+        self._window_start = clock()
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """
+        Tells whether a record is let through.
+        """
+        if getattr(record, 'sampling_summary', False):
+            return True
+        now = self.clock()
+        with self._lock:
+            allowed = self._allow(self.key(record), now)
+            if allowed:
+                self.passed += 1
+            else:
+                self.suppressed += 1
+            summary = None
+            if now - self._window_start >= self.summary_interval:
+                summary = self._close_window(now)
+        if summary is not None:
+            self._emit_summary(record.name, summary)
+        return allowed
+
+    def _allow(self, key: Hashable, now: float) -> bool:
+        """
+        Applies the token bucket and the first N then 1-in-M sampling.
+        """
+        if self.rate is not None:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                self._buckets[key] = bucket
+            if not bucket.take(now):
+                return False
+        if self.first_n is None:
+            return True
+        seen = self._seen.get(key, 0) + 1
+        self._seen[key] = seen
+        if seen <= self.first_n:
+            return True
+        return (seen - self.first_n) % self.every_m == 0
+
+    def _close_window(self, now: float) -> tuple:
+        """
+        Resets the window counters and returns what they held.
+        Buckets refilled since their last use are dropped, as a new
+        bucket would start full too; this keeps keys seen once from
+        piling up.
+        """
+        summary = (self.passed, self.suppressed, now - self._window_start)
+        self.passed = 0
+        self.suppressed = 0
+        self._seen.clear()
+        for key in [key for key, bucket in self._buckets.items()
+                    if bucket.full(now)]:
+            del self._buckets[key]
+        self._window_start = now
+        return summary
+
+    def _emit_summary(self, name: str, summary: tuple):
+        """
+        Logs the summary line of a closed window when records were
+        suppressed during it.
+        """
+        passed, suppressed, elapsed = summary
+        if not suppressed:
+            return
+        msg = "sampling: suppressed {} of {} records in {:.0f}s".format(
+            suppressed, passed + suppressed, elapsed)
+        record = logging.LogRecord(
+            name, logging.WARNING, __file__, 0, msg, None, None)
+        record.sampling_summary = True
+        logging.getLogger(name).handle(record)
+
+    def flush_summary(self, name: str = "user_data"):
+        """
+        Closes the current window and logs its summary line.
+        """
+        with self._lock:
+            summary = self._close_window(self.clock())
+        self._emit_summary(name, summary)
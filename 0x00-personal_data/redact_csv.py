@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Module for redacting the PII columns of large CSV exports.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from typing import Callable, Iterable, Iterator, List, Sequence, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, redact_row
+
+
+BUFFER_SIZE = 1 << 20
+
+
+def bounded_imap(
+        pool: Pool, func: Callable, iterable: Iterable, window: int,
+        ) -> Iterator:
+    """
+    Maps func over iterable in a process pool, yielding the results
+    in input order while keeping at most window tasks in flight.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def read_chunks(rows: Iterable, size: int) -> Iterator[List]:
+    """
+    Groups rows into lists of at most size rows.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def redact_chunk(job: Tuple) -> Tuple[str, int]:
+    """
+    Redacts a chunk of CSV rows and returns it as CSV text.
+    """
+    header, fields, rows = job
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for row in rows:
+        writer.writerow(
+            redact_row(header, row, fields, RedactingFormatter.REDACTION))
+    return out.getvalue(), len(rows)
+
+
+def redact_csv(
+        input_path: str, output_path: str,
+        fields: Sequence[str] = PII_FIELDS, chunk_size: int = 10000,
+        workers: int = None,
+        ) -> Tuple[int, float]:
+    """
+    Streams a CSV file, redacting the fields columns found in its header.
+    Returns the number of data rows written and the elapsed seconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    count = 0
+    with open(input_path, 'r', newline='', buffering=BUFFER_SIZE) as src, \
+            open(output_path, 'w', newline='', buffering=BUFFER_SIZE) as dst:
+        reader = csv.reader(src)
+        header = tuple(next(reader, ()))
+        if not header:
+            return 0, time.perf_counter() - start
+        csv.writer(dst).writerow(header)
+        jobs = (
+            (header, tuple(fields), chunk)
+            for chunk in read_chunks(reader, chunk_size)
+        )
+        if workers == 1:
+            results = map(redact_chunk, jobs)
+            for text, rows in results:
+                dst.write(text)
+                count += rows
+        else:
+            with Pool(workers) as pool:
+                for text, rows in bounded_imap(
+                        pool, redact_chunk, jobs, workers * 2):
+                    dst.write(text)
+                    count += rows
+    return count, time.perf_counter() - start
+
+
+def main():
+    """
+    Redacts a CSV file from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input", help="CSV file to redact")
+    parser.add_argument("output", help="redacted CSV file to write")
+    parser.add_argument("--chunk-size", type=int, default=10000,
+                        help="rows per chunk handed to a worker")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--fields", default=",".join(PII_FIELDS),
+                        help="comma separated columns to redact")
+    args = parser.parse_args()
+    count, elapsed = redact_csv(
+        args.input, args.output, args.fields.split(','),
+        args.chunk_size, args.workers,
+    )
+    rate = count / elapsed if elapsed else float(count)
+    print("{} rows in {:.2f}s ({:.0f} rows/sec)".format(
+        count, elapsed, rate), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
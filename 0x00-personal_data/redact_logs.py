@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Module for re-redacting existing log files in parallel.
+"""
+
+import argparse
+import mmap
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import Iterator, Sequence, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, redaction_engine
+from redact_csv import bounded_imap
+
+
+WRITE_BUFFER_SIZE = 16 << 20
+
+
+def chunk_bounds(path: str, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yields (start, end) offsets splitting a file into chunks of about
+    chunk_size bytes, each ending on a newline.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                newline = mm.find(b'\n', end - 1)
+                end = size if newline == -1 else newline + 1
+            yield start, end
+            start = end
+
+
+def redact_span(job: Tuple) -> bytes:
+    """
+    Redacts the lines between two offsets of a memory-mapped file.
+    The separator class also stops at line ends, LF or CRLF, so each
+    line is redacted exactly as filter_datum would redact it on its own.
+    """
+    path, start, end, fields, separator = job
+    redact = redaction_engine.compile(
+        fields, RedactingFormatter.REDACTION, separator + '\r\n')
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode('utf-8', 'surrogateescape')
+    return redact(text).encode('utf-8', 'surrogateescape')
+
+
+def redact_log(
+        input_path: str, output_path: str,
+        fields: Sequence[str] = PII_FIELDS,
+        separator: str = RedactingFormatter.SEPARATOR,
+        chunk_size: int = 64 << 20, workers: int = None,
+        ) -> Tuple[int, float]:
+    """
+    Redacts a log file into output_path using a pool of workers.
+    Returns the number of bytes read and the elapsed seconds.
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    jobs = (
+        (input_path, low, high, tuple(fields), separator)
+        for low, high in chunk_bounds(input_path, chunk_size)
+    )
+    with open(output_path, 'wb', buffering=WRITE_BUFFER_SIZE) as dst:
+        if workers == 1:
+            for data in map(redact_span, jobs):
+                dst.write(data)
+        else:
+            with Pool(workers) as pool:
+                for data in bounded_imap(pool, redact_span, jobs, workers * 2):
+                    dst.write(data)
+    return os.path.getsize(input_path), time.perf_counter() - start
+
+
+def main():
+    """
+    Redacts a log file from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input", help="log file to redact")
+    parser.add_argument("output", help="redacted log file to write")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="chunk size in MiB handed to a worker")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--fields", default=",".join(PII_FIELDS),
+                        help="comma separated fields to redact")
+    parser.add_argument("--separator", default=RedactingFormatter.SEPARATOR,
+                        help="separator between fields")
+    args = parser.parse_args()
+    size, elapsed = redact_log(
+        args.input, args.output, args.fields.split(','), args.separator,
+        args.chunk_size << 20, args.workers,
+    )
+    rate = size / elapsed / (1 << 20) if elapsed else 0.0
+    print("{} bytes in {:.2f}s ({:.1f} MiB/sec)".format(
+        size, elapsed, rate), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
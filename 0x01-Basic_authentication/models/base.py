@@ -2,20 +2,468 @@
 """ Base module
 """
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from contextlib import contextmanager
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+from os import getenv, path
+import atexit
+import calendar
 import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
 
+# 'file' rewrites .db_<Class>.json on every change, 'journal' appends
+# one line per change to .db_<Class>.journal and compacts it once it
+# holds JOURNAL_COMPACT_RATIO times more entries than there are objects
+STORAGE_MODE = getenv('MODELS_STORAGE_MODE', 'file')
+JOURNAL_COMPACT_RATIO = float(getenv('MODELS_JOURNAL_COMPACT_RATIO', '2'))
+JOURNAL_COMPACT_MIN = 1000
+JOURNALS = {}
+# Equality indexes of the INDEXED_ATTRIBUTES of each class:
+# INDEXES[class][attribute][value] holds the ids of the matching objects
+# and INDEXED_VALUES[class][id] the values an object is indexed under
+INDEXES = {}
+INDEXED_VALUES = {}
+# With MODELS_LAZY_LOAD=1, load_from_file() keeps each record as its raw
+# JSON text in RAW[class][id] until get()/search() first needs it
+LAZY_LOAD = getenv('MODELS_LAZY_LOAD', '0') == '1'
+RAW = {}
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+UNHASHABLE = object()
+SLOT_NAMES = {}
+JOURNAL_LOCK = threading.Lock()
+COMPACT_LOCK = threading.Lock()
+# Per-class reader/writer locks over DATA, RAW and the indexes
+LOCKS = {}
+LOCKS_LOCK = threading.Lock()
+# In file mode, a positive MODELS_WRITE_BEHIND_INTERVAL makes save() and
+# remove() only mark the class dirty; a background thread then writes
+# each dirty class at most once per interval, and once more at exit.
+# MODELS_FSYNC=always fsyncs every snapshot and journal entry
+WRITE_BEHIND_INTERVAL = float(getenv('MODELS_WRITE_BEHIND_INTERVAL', '0'))
+FSYNC_POLICY = getenv('MODELS_FSYNC', 'never')
+DIRTY = set()
+DIRTY_LOCK = threading.Lock()
+FLUSHER = None
+# MODELS_STORAGE_BACKEND picks where objects are kept: 'file' (default)
+# in DATA and the files above, 'sqlite' in the MODELS_SQLITE_PATH
+# database; set_storage() plugs in any other Storage
+STORAGE_BACKEND = getenv('MODELS_STORAGE_BACKEND', 'file')
+SQLITE_PATH = getenv('MODELS_SQLITE_PATH', '.db.sqlite3')
+STORAGE = None
+STORAGE_LOCK = threading.Lock()
+
+
+def iter_json_items(f, chunk_size: int = 1 << 16) -> Iterator[tuple]:
+    """
+    Parse a file holding one JSON object incrementally and yield
+    (key, raw value text, parsed value) for each of its items.
+    """
+    scan = json.JSONDecoder().scan_once
+    skip = WHITESPACE.match
+    buf = ''
+    while not buf.strip():
+        chunk = f.read(chunk_size)
+        if not chunk:
+            raise ValueError("expected a JSON object")
+        buf += chunk
+    pos = skip(buf).end()
+    if buf[pos] != '{':
+        raise ValueError("expected a JSON object")
+    pos += 1
+    first = True
+    while True:
+        # Parse `"key": value,` in one go, reading more and starting
+        # over from the key when the item runs past the buffer
+        try:
+            end = skip(buf, pos).end()
+            if first and buf[end] == '}':
+                return
+            key, end = scan(buf, end)
+            end = skip(buf, end).end()
+            if buf[end] != ':':
+                raise ValueError("expected ':' after {!r}".format(key))
+            start = skip(buf, end + 1).end()
+            value, value_end = scan(buf, start)
+            end = skip(buf, value_end).end()
+            token = buf[end]
+        except (StopIteration, IndexError, ValueError):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError("truncated JSON object")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield key, buf[start:value_end], value
+        first = False
+        pos = end + 1
+        if token == '}':
+            return
+        if token != ',':
+            raise ValueError("expected ',' or '}}' after {!r}".format(key))
+
+
+def index_values(s_class: str, obj_id: str, values: dict):
+    """
+    Index an object of s_class under the values of its indexed attributes.
+    """
+    indexed = []
+    for attr, index in INDEXES.get(s_class, {}).items():
+        value = values.get(attr)
+        try:
+            index.setdefault(value, {})[obj_id] = None
+        except TypeError:
+            value = UNHASHABLE
+        indexed.append(value)
+    INDEXED_VALUES.setdefault(s_class, {})[obj_id] = tuple(indexed)
+
+
+def unindex(s_class: str, obj_id: str):
+    """
+    Drop an object of s_class from the indexes, using the values
+    it was indexed with.
+    """
+    values = INDEXED_VALUES.get(s_class, {}).pop(obj_id, ())
+    for index, value in zip(INDEXES.get(s_class, {}).values(), values):
+        ids = index.get(value) if value is not UNHASHABLE else None
+        if ids is None:
+            continue
+        ids.pop(obj_id, None)
+        if not ids:
+            del index[value]
+
+
+class ReadWriteLock():
+    """
+    Lock letting many readers in at once while writers get exclusive
+    access. Waiting writers block new readers so they are not starved.
+    The writing thread may take the lock again, for reading or writing.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        """
+        Hold the lock for reading.
+        """
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        """
+        Hold the lock for writing.
+        """
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._writes += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writes -= 1
+                if not self._writes:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+def lock_for(s_class: str) -> ReadWriteLock:
+    """
+    Return the lock guarding the objects of a class.
+    """
+    lock = LOCKS.get(s_class)
+    if lock is None:
+        with LOCKS_LOCK:
+            lock = LOCKS.setdefault(s_class, ReadWriteLock())
+    return lock
+
+
+def flush_dirty():
+    """
+    Write the snapshot of every class changed since the last flush.
+    Classes that could not be written stay dirty for the next one.
+    """
+    with DIRTY_LOCK:
+        classes = list(DIRTY)
+        DIRTY.clear()
+    failed = []
+    for cls in classes:
+        try:
+            cls.save_to_file()
+        except Exception:
+            logging.getLogger(__name__).exception(
+                "cannot write the objects of %s", cls.__name__)
+            failed.append(cls)
+    if failed:
+        with DIRTY_LOCK:
+            DIRTY.update(failed)
+
+
+def run_flusher():
+    """
+    Flush the dirty classes every WRITE_BEHIND_INTERVAL seconds.
+    """
+    while True:
+        time.sleep(WRITE_BEHIND_INTERVAL)
+        flush_dirty()
+
+
+atexit.register(flush_dirty)
+
+
+def parse_timestamp(value: str) -> int:
+    """
+    Convert a TIMESTAMP_FORMAT string to epoch seconds.
+    """
+    if len(value) == 19 and value[10] == 'T':
+        return calendar.timegm((
+            int(value[0:4]), int(value[5:7]), int(value[8:10]),
+            int(value[11:13]), int(value[14:16]), int(value[17:19]),
+        ))
+    dt = datetime.strptime(value, TIMESTAMP_FORMAT)
+    return calendar.timegm(dt.utctimetuple())
+
+
+class Storage():
+    """
+    Interface of the places model objects are kept in. Methods get the
+    model class, or the object, they work on.
+    """
+
+    def load(self, cls):
+        """
+        Load, or open, the objects of a class.
+        """
+        raise NotImplementedError
+
+    def save(self, obj: TypeVar('Base')):
+        """
+        Store an object, replacing any previous version.
+        """
+        raise NotImplementedError
+
+    def remove(self, obj: TypeVar('Base')):
+        """
+        Drop an object.
+        """
+        raise NotImplementedError
+
+    def count(self, cls) -> int:
+        """
+        Count the objects of a class.
+        """
+        raise NotImplementedError
+
+    def get(self, cls, obj_id: str) -> TypeVar('Base'):
+        """
+        Return one object of a class by ID, or None.
+        """
+        raise NotImplementedError
+
+    def search(self, cls, attributes: dict) -> List[TypeVar('Base')]:
+        """
+        Return the objects of a class with matching attributes.
+        """
+        raise NotImplementedError
+
+
+class FileStorage(Storage):
+    """
+    Keeps the objects in DATA and writes them to .db_<Class>.json,
+    as set by STORAGE_MODE, LAZY_LOAD and WRITE_BEHIND_INTERVAL.
+    """
+
+    def load(self, cls):
+        """
+        Load all objects of a class from file.
+        """
+        s_class = cls.__name__
+        with lock_for(s_class).write():
+            file_path = cls.file_path()
+            DATA[s_class] = {}
+            RAW[s_class] = {}
+            JOURNALS[s_class] = 0
+            INDEXES[s_class] = {attr: {} for attr in cls.INDEXED_ATTRIBUTES}
+            INDEXED_VALUES[s_class] = {}
+            if path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    if LAZY_LOAD:
+                        for obj_id, raw, obj_json in iter_json_items(f):
+                            RAW[s_class][obj_id] = raw
+                            index_values(s_class, obj_id, obj_json)
+                    else:
+                        objs_json = json.load(f)
+                        for obj_id, obj_json in objs_json.items():
+                            DATA[s_class][obj_id] = cls(**obj_json)
+
+            journal_path = cls.journal_path()
+            for replay_path in (journal_path + '.compacting', journal_path):
+                if path.exists(replay_path):
+                    JOURNALS[s_class] += cls.replay_journal(replay_path)
+            if not LAZY_LOAD:
+                cls.rebuild_indexes()
+
+    def save(self, obj: TypeVar('Base')):
+        """
+        Store an object.
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        with lock_for(s_class).write():
+            DATA[s_class][obj.id] = obj
+            RAW.get(s_class, {}).pop(obj.id, None)
+            obj.remove_from_indexes()
+            obj.add_to_indexes()
+        if STORAGE_MODE == 'journal':
+            cls.append_to_journal(
+                'save', obj.id, obj.to_json(True))
+        elif WRITE_BEHIND_INTERVAL > 0:
+            cls.mark_dirty()
+        else:
+            cls.save_to_file()
+
+    def remove(self, obj: TypeVar('Base')):
+        """
+        Drop an object.
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        with lock_for(s_class).write():
+            # A lazily loaded record may still be raw JSON in RAW
+            removed = DATA[s_class].pop(obj.id, None)
+            raw = RAW.get(s_class, {}).pop(obj.id, None)
+            if removed is None and raw is None:
+                return
+            obj.remove_from_indexes()
+        if STORAGE_MODE == 'journal':
+            cls.append_to_journal('remove', obj.id)
+        elif WRITE_BEHIND_INTERVAL > 0:
+            cls.mark_dirty()
+        else:
+            cls.save_to_file()
+
+    def count(self, cls) -> int:
+        """
+        Count the objects of a class.
+        """
+        s_class = cls.__name__
+        with lock_for(s_class).read():
+            return len(DATA[s_class].keys()) + len(RAW.get(s_class, {}))
+
+    def get(self, cls, obj_id: str) -> TypeVar('Base'):
+        """
+        Return one object of a class by ID, or None.
+        """
+        s_class = cls.__name__
+        cls.materialize((obj_id,))
+        with lock_for(s_class).read():
+            return DATA[s_class].get(obj_id)
+
+    def search(self, cls, attributes: dict) -> List[TypeVar('Base')]:
+        """
+        Return the objects of a class with matching attributes.
+        """
+        s_class = cls.__name__
+        lock = lock_for(s_class)
+
+        def _search(obj):
+            if len(attributes) == 0:
+                return True
+            for k, v in attributes.items():
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        # Narrow down to the objects indexed with an equal value; they
+        # are still checked since unsaved changes are not indexed
+        ids = None
+        with lock.read():
+            indexes = INDEXES.get(s_class, {})
+            for k, v in attributes.items():
+                if k not in indexes:
+                    continue
+                try:
+                    ids = list(indexes[k].get(v, {}))
+                except TypeError:
+                    continue
+                break
+
+        cls.materialize(ids)
+        with lock.read():
+            objs = DATA[s_class]
+            if ids is not None:
+                objs = {i: objs[i] for i in ids if i in objs}
+            return list(filter(_search, objs.values()))
+
+
+def get_storage() -> Storage:
+    """
+    Return the storage of the models, picked by STORAGE_BACKEND.
+    """
+    global STORAGE
+    with STORAGE_LOCK:
+        if STORAGE is None:
+            if STORAGE_BACKEND == 'sqlite':
+                from models.sqlite_storage import SQLiteStorage
+                STORAGE = SQLiteStorage(SQLITE_PATH)
+            else:
+                STORAGE = FileStorage()
+        return STORAGE
+
+
+def set_storage(storage: Storage):
+    """
+    Keep the model objects in another storage from now on.
+    """
+    global STORAGE
+    with STORAGE_LOCK:
+        STORAGE = storage
+
 
 class Base():
     """ Base class
     """
 
+    INDEXED_ATTRIBUTES: Tuple[str, ...] = ()
+    # Fields live in slots and timestamps in epoch seconds, exposed as
+    # datetime objects through the created_at/updated_at properties
+    __slots__ = ('id', '_created_ts', '_updated_ts')
+    TIMESTAMP_SLOTS = {
+        '_created_ts': 'created_at',
+        '_updated_ts': 'updated_at',
+    }
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
@@ -25,15 +473,56 @@ class Base():
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self._created_ts = parse_timestamp(kwargs.get('created_at'))
         else:
-            self.created_at = datetime.utcnow()
+            self._created_ts = int(time.time())
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self._updated_ts = parse_timestamp(kwargs.get('updated_at'))
         else:
-            self.updated_at = datetime.utcnow()
+            self._updated_ts = int(time.time())
+
+    @property
+    def created_at(self) -> datetime:
+        """
+        Creation time, in UTC.
+        """
+        return datetime.utcfromtimestamp(self._created_ts)
+
+    @created_at.setter
+    def created_at(self, value: datetime):
+        """
+        Set the creation time.
+        """
+        self._created_ts = calendar.timegm(value.utctimetuple())
+
+    @property
+    def updated_at(self) -> datetime:
+        """
+        Last update time, in UTC.
+        """
+        return datetime.utcfromtimestamp(self._updated_ts)
+
+    @updated_at.setter
+    def updated_at(self, value: datetime):
+        """
+        Set the last update time.
+        """
+        self._updated_ts = calendar.timegm(value.utctimetuple())
+
+    @classmethod
+    def slot_names(cls) -> Tuple[str, ...]:
+        """
+        Names of the slots of the class and of its bases, bases first.
+        """
+        names = SLOT_NAMES.get(cls)
+        if names is None:
+            names = tuple(
+                name
+                for klass in reversed(cls.__mro__)
+                for name in klass.__dict__.get('__slots__', ())
+            )
+            SLOT_NAMES[cls] = names
+        return names
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -48,7 +537,16 @@ class Base():
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for name in self.slot_names():
+            if not hasattr(self, name):
+                continue
+            if name in self.TIMESTAMP_SLOTS:
+                result[self.TIMESTAMP_SLOTS[name]] = time.strftime(
+                    TIMESTAMP_FORMAT, time.gmtime(getattr(self, name)))
+            elif for_serialization or name[0] != '_':
+                result[name] = getattr(self, name)
+        # Subclasses without __slots__ keep their other fields in __dict__
+        for key, value in getattr(self, '__dict__', {}).items():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -57,56 +555,215 @@ class Base():
                 result[key] = value
         return result
 
+    @classmethod
+    def file_path(cls) -> str:
+        """
+        Path of the JSON file storing the objects of the class.
+        """
+        return ".db_{}.json".format(cls.__name__)
+
+    @classmethod
+    def journal_path(cls) -> str:
+        """
+        Path of the journal of changes made since the last snapshot.
+        """
+        return ".db_{}.journal".format(cls.__name__)
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from the storage
+        """
+        get_storage().load(cls)
+
+    @classmethod
+    def materialize(cls, ids: Iterable[str] = None):
+        """
+        Build the objects still held as raw JSON, all of them by default.
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        raws = RAW.get(s_class)
+        if not raws:
             return
+        if ids is not None and not any(i in raws for i in ids):
+            return
+        with lock_for(s_class).write():
+            for obj_id in list(raws if ids is None else ids):
+                raw = raws.pop(obj_id, None)
+                if raw is not None:
+                    DATA[s_class][obj_id] = cls(**json.loads(raw))
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """
+        Rebuild the indexes of the class from the loaded objects.
+        """
+        s_class = cls.__name__
+        INDEXES[s_class] = {attr: {} for attr in cls.INDEXED_ATTRIBUTES}
+        INDEXED_VALUES[s_class] = {}
+        for obj in DATA[s_class].values():
+            obj.add_to_indexes()
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    def add_to_indexes(self):
+        """
+        Index the current values of the indexed attributes.
+        """
+        s_class = self.__class__.__name__
+        if s_class not in INDEXES:
+            INDEXES[s_class] = {
+                attr: {} for attr in self.INDEXED_ATTRIBUTES}
+        values = {
+            attr: getattr(self, attr, None)
+            for attr in self.INDEXED_ATTRIBUTES
+        }
+        index_values(s_class, self.id, values)
+
+    def remove_from_indexes(self):
+        """
+        Drop the object from the indexes.
+        """
+        unindex(self.__class__.__name__, self.id)
+
+    @classmethod
+    def replay_journal(cls, journal_path: str) -> int:
+        """
+        Apply the entries of a journal file, return how many were read.
+        """
+        s_class = cls.__name__
+        count = 0
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Entry truncated by a crash while it was appended
+                    continue
+                count += 1
+                obj_id = entry['id']
+                DATA[s_class].pop(obj_id, None)
+                RAW[s_class].pop(obj_id, None)
+                if LAZY_LOAD:
+                    unindex(s_class, obj_id)
+                if entry['op'] != 'save':
+                    continue
+                if LAZY_LOAD:
+                    RAW[s_class][obj_id] = json.dumps(entry['obj'])
+                    index_values(s_class, obj_id, entry['obj'])
+                else:
+                    DATA[s_class][obj_id] = cls(**entry['obj'])
+        return count
+
+    @classmethod
+    def append_to_journal(cls, op: str, obj_id: str, obj_json: dict = None):
+        """
+        Append a 'save' or 'remove' entry to the journal and start
+        a background compaction once the journal grew too large.
+        """
+        s_class = cls.__name__
+        entry = json.dumps({'op': op, 'id': obj_id, 'obj': obj_json})
+        with JOURNAL_LOCK:
+            with open(cls.journal_path(), 'a') as f:
+                f.write(entry + '\n')
+                if FSYNC_POLICY == 'always':
+                    f.flush()
+                    os.fsync(f.fileno())
+            JOURNALS[s_class] = JOURNALS.get(s_class, 0) + 1
+            threshold = max(JOURNAL_COMPACT_MIN,
+                            JOURNAL_COMPACT_RATIO * cls.count())
+            compact = JOURNALS[s_class] > threshold
+        if compact and not COMPACT_LOCK.locked():
+            threading.Thread(target=cls.save_to_file, daemon=True).start()
+
+    @classmethod
+    def mark_dirty(cls):
+        """
+        Schedule a snapshot of the class with the write-behind flusher.
+        """
+        global FLUSHER
+        with DIRTY_LOCK:
+            DIRTY.add(cls)
+            if FLUSHER is None:
+                FLUSHER = threading.Thread(target=run_flusher, daemon=True)
+                FLUSHER.start()
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
-
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+        file_path = cls.file_path()
+        with COMPACT_LOCK:
+            if STORAGE_MODE == 'journal':
+                # Later changes go to a fresh journal while the snapshot
+                # is written; the old one is replayed if we crash
+                journal_path = cls.journal_path()
+                compacting_path = journal_path + '.compacting'
+                with JOURNAL_LOCK, lock_for(s_class).read():
+                    objs = list(DATA[s_class].items())
+                    raws = list(RAW.get(s_class, {}).items())
+                    if path.exists(journal_path):
+                        if path.exists(compacting_path):
+                            # Left by a compaction that did not finish:
+                            # its entries are still needed, keep them
+                            with open(journal_path, 'r') as src, \
+                                    open(compacting_path, 'a') as dst:
+                                shutil.copyfileobj(src, dst)
+                                if FSYNC_POLICY == 'always':
+                                    dst.flush()
+                                    os.fsync(dst.fileno())
+                            os.remove(journal_path)
+                        else:
+                            os.replace(journal_path, compacting_path)
+                    JOURNALS[s_class] = 0
+            else:
+                with lock_for(s_class).read():
+                    objs = list(DATA[s_class].items())
+                    raws = list(RAW.get(s_class, {}).items())
+            # Written item by item so records still held as raw JSON
+            # are copied as they are instead of being rebuilt
+            tmp_path = file_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('{')
+                sep = ''
+                for obj_id, obj in objs:
+                    f.write('{}{}: {}'.format(sep, json.dumps(obj_id),
+                                              json.dumps(obj.to_json(True))))
+                    sep = ', '
+                for obj_id, raw in raws:
+                    f.write('{}{}: {}'.format(sep, json.dumps(obj_id), raw))
+                    sep = ', '
+                f.write('}')
+                if FSYNC_POLICY == 'always':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+            if STORAGE_MODE == 'journal':
+                if path.exists(compacting_path):
+                    os.remove(compacting_path)
+            else:
+                # Journals left by an earlier run in journal mode were
+                # replayed on load and are in the snapshot now; replayed
+                # again they would undo the changes made since
+                journal_path = cls.journal_path()
+                for old_path in (journal_path + '.compacting', journal_path):
+                    if path.exists(old_path):
+                        os.remove(old_path)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        get_storage().save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        get_storage().remove(self)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return get_storage().count(cls)
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +775,10 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return get_storage().get(cls, id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        return get_storage().search(cls, attributes)
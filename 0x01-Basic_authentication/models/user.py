@@ -9,6 +9,9 @@ class User(Base):
     """ User class
     """
 
+    INDEXED_ATTRIBUTES = ('email',)
+    __slots__ = ('email', '_password', 'first_name', 'last_name')
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
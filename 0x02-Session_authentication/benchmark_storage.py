@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the file and SQLite storages of the models on User objects.
+The file storage runs in the mode set by the MODELS_* variables.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from typing import Callable, Dict, List
+
+from models import base
+from models.base import FileStorage, Storage
+from models.sqlite_storage import SQLiteStorage
+from models.user import User
+
+
+def write_users(count: int, seed: int = 0) -> List[str]:
+    """
+    Writes .db_User.json with count users and returns their ids.
+    """
+    rng = random.Random(seed)
+    ids = []
+    with open(User.file_path(), 'w') as f:
+        f.write('{')
+        for i in range(count):
+            obj_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            ids.append(obj_id)
+            record = {
+                'id': obj_id,
+                'created_at': '2024-01-01T00:00:00',
+                'updated_at': '2024-01-01T00:00:00',
+                'email': 'user{}@example.com'.format(i),
+                '_password': '{:064x}'.format(i),
+                'first_name': 'First{}'.format(i % 100),
+                'last_name': 'Last{}'.format(i),
+            }
+            f.write('{}{}: {}'.format(', ' if i else '', json.dumps(obj_id),
+                                      json.dumps(record)))
+        f.write('}')
+    return ids
+
+
+def mean_time(run: Callable, args: List) -> float:
+    """
+    Mean duration in seconds of run over each of args.
+    """
+    start = time.perf_counter()
+    for arg in args:
+        run(arg)
+    return (time.perf_counter() - start) / max(1, len(args))
+
+
+def update(obj_id: str):
+    """
+    Changes one field of a user and saves it.
+    """
+    user = User.get(obj_id)
+    user.first_name = 'Updated'
+    user.save()
+
+
+def bench_storage(storage: Storage, ids: List[str], ops: int,
+                  save_ops: int, scan_ops: int) -> Dict[str, float]:
+    """
+    Times the User operations against storage.
+    """
+    rng = random.Random(1)
+    count = len(ids)
+    base.set_storage(storage)
+    start = time.perf_counter()
+    User.load_from_file()
+    result = {'load_s': time.perf_counter() - start}
+    picks = [rng.choice(ids) for _ in range(ops)]
+    emails = ['user{}@example.com'.format(rng.randrange(count))
+              for _ in range(ops)]
+    result['get_us'] = mean_time(User.get, picks) * 1e6
+    result['search_us'] = mean_time(
+        lambda email: User.search({'email': email}), emails) * 1e6
+    result['scan_ms'] = mean_time(
+        lambda name: User.search({'first_name': name}),
+        ['First{}'.format(i) for i in range(scan_ops)]) * 1e3
+    result['count_us'] = mean_time(lambda _: User.count(), picks) * 1e6
+    result['save_ms'] = mean_time(update, picks[:save_ops]) * 1e3
+    base.flush_dirty()
+    return result
+
+
+def reset():
+    """
+    Drops the objects kept in memory by the file storage.
+    """
+    for store in (base.DATA, base.RAW, base.INDEXES, base.INDEXED_VALUES):
+        store.pop('User', None)
+
+
+def main():
+    """
+    Runs both storages on each size and prints a report.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated user counts")
+    parser.add_argument("--ops", type=int, default=1000,
+                        help="get, search and count calls per size")
+    parser.add_argument("--save-ops", type=int, default=5,
+                        help="saves per size")
+    parser.add_argument("--scan-ops", type=int, default=3,
+                        help="searches on a non-indexed field per size")
+    args = parser.parse_args()
+    print("{:>8} {:<14} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "users", "storage", "load s", "save ms", "get us", "search us",
+        "scan ms", "count us"))
+    cwd = os.getcwd()
+    for size in [int(n) for n in args.sizes.split(',')]:
+        tmp_dir = tempfile.mkdtemp(prefix="models_bench_")
+        os.chdir(tmp_dir)
+        try:
+            ids = write_users(size)
+            db_path = os.path.join(tmp_dir, 'bench.sqlite3')
+            runs = [
+                ('file', FileStorage()),
+                # The first load imports .db_User.json, later ones open
+                ('sqlite import', SQLiteStorage(db_path)),
+                ('sqlite', SQLiteStorage(db_path)),
+            ]
+            for name, storage in runs:
+                r = bench_storage(storage, ids, args.ops, args.save_ops,
+                                  args.scan_ops)
+                reset()
+                print("{:>8} {:<14} {:>8.2f} {:>9.2f} {:>9.1f} {:>9.1f} "
+                      "{:>9.1f} {:>9.1f}".format(
+                          size, name, r['load_s'], r['save_ms'], r['get_us'],
+                          r['search_us'], r['scan_ms'], r['count_us']))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+SQLite storage of the models
+"""
+import json
+import sqlite3
+import threading
+from os import path
+from typing import List, TypeVar
+
+from models.base import FSYNC_POLICY, Storage, iter_json_items
+
+
+def quote(name: str) -> str:
+    """
+    Quote a table, column or index name.
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def literal(value: str) -> str:
+    """
+    Quote a string literal, where parameters cannot be used.
+    """
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def column_value(value):
+    """
+    Value stored in an indexed column: scalars as they are, anything
+    else as JSON text.
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value)
+
+
+def save_params(cls, obj_id: str, data: str, values: dict) -> tuple:
+    """
+    Parameters of the statement saving an object of cls, given its JSON
+    text and the values of its attributes.
+    """
+    return (obj_id, data) + tuple(
+        column_value(values.get(attr)) for attr in cls.INDEXED_ATTRIBUTES)
+
+
+class SQLiteStorage(Storage):
+    """
+    Keeps each model class in a table of a SQLite database in WAL mode,
+    so several processes can share it. An object is a row holding its
+    id, its JSON and one indexed column per INDEXED_ATTRIBUTES entry.
+    Triggers keep the number of rows of each table in model_counts, as
+    COUNT(*) has to walk the whole table, and model_imports records the
+    classes whose JSON files were already looked at.
+    Statements are the same for every call, and sqlite3 keeps them
+    prepared in the statement cache of each connection.
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30):
+        """
+        Use the database at db_path, waiting up to timeout seconds
+        for the locks held by other connections.
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Connection of the calling thread, opened on first use.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous={}'.format(
+                'FULL' if FSYNC_POLICY == 'always' else 'NORMAL'))
+            self._local.conn = conn
+        return conn
+
+    def statements(self, cls) -> dict:
+        """
+        SQL statements of a class, creating its table on first use.
+        """
+        s_class = cls.__name__
+        statements = self._statements.get(s_class)
+        if statements is None:
+            with self._lock:
+                statements = self._statements.get(s_class)
+                if statements is None:
+                    statements = self.create_table(cls)
+                    self._statements[s_class] = statements
+        return statements
+
+    def create_table(self, cls) -> dict:
+        """
+        Create the table of a class and the indexes of its
+        INDEXED_ATTRIBUTES, adding the columns of newly indexed ones.
+        """
+        s_class = cls.__name__
+        table = quote(s_class)
+        columns = tuple(cls.INDEXED_ATTRIBUTES)
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS {} '
+                         '(id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+                         .format(table))
+            conn.execute('CREATE TABLE IF NOT EXISTS model_counts '
+                         '(name TEXT PRIMARY KEY, count INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS model_imports '
+                         '(name TEXT PRIMARY KEY)')
+            conn.execute('INSERT OR IGNORE INTO model_counts (name, count) '
+                         'SELECT ?, COUNT(*) FROM {}'.format(table),
+                         (s_class,))
+            for event, change in (('INSERT', '+ 1'), ('DELETE', '- 1')):
+                conn.execute(
+                    'CREATE TRIGGER IF NOT EXISTS {} AFTER {} ON {} BEGIN '
+                    'UPDATE model_counts SET count = count {} '
+                    'WHERE name = {}; END'.format(
+                        quote('{}_{}'.format(s_class, event.lower())),
+                        event, table, change, literal(s_class)))
+            existing = {row[1] for row in conn.execute(
+                'PRAGMA table_info({})'.format(table))}
+            for attr in columns:
+                if attr not in existing:
+                    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                        table, quote(attr)))
+                    conn.execute('UPDATE {} SET {} = json_extract(data, ?)'
+                                 .format(table, quote(attr)), ('$.' + attr,))
+                conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    quote('{}_{}'.format(s_class, attr)), table,
+                    quote(attr)))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        names = [quote(name) for name in ('data',) + columns]
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete
+        # would not fire the count trigger
+        return {
+            'save': 'INSERT INTO {} (id, {}) VALUES ({}) ON CONFLICT(id) '
+                    'DO UPDATE SET {}'.format(
+                        table, ', '.join(names),
+                        ', '.join('?' * (len(names) + 1)),
+                        ', '.join('{0} = excluded.{0}'.format(name)
+                                  for name in names)),
+            'remove': 'DELETE FROM {} WHERE id = ?'.format(table),
+            'get': 'SELECT data FROM {} WHERE id = ?'.format(table),
+            'count': 'SELECT count FROM model_counts WHERE name = ?',
+            'select': 'SELECT data FROM {}'.format(table),
+            'any': 'SELECT 1 FROM {} LIMIT 1'.format(table),
+            'imported': 'SELECT 1 FROM model_imports WHERE name = ?',
+            'mark_imported': 'INSERT INTO model_imports (name) VALUES (?)',
+        }
+
+    def load(self, cls):
+        """
+        Open the table of a class. The first time, .db_<Class>.json and
+        its journal are imported into it, unless the table already holds
+        objects; later loads never import them again, even once every
+        object was removed.
+        """
+        s_class = cls.__name__
+        statements = self.statements(cls)
+        conn = self.connection()
+        if conn.execute(statements['imported'], (s_class,)).fetchone():
+            return
+        journal_path = cls.journal_path()
+        replay_paths = [p for p in (journal_path + '.compacting',
+                                    journal_path) if path.exists(p)]
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Checked again now that other processes are locked out
+            if not conn.execute(statements['imported'],
+                                (s_class,)).fetchone():
+                if conn.execute(statements['any']).fetchone() is None:
+                    self.import_files(cls, conn, replay_paths)
+                conn.execute(statements['mark_imported'], (s_class,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def import_files(self, cls, conn: sqlite3.Connection,
+                     replay_paths: List[str]):
+        """
+        Copy the JSON file of a class, then apply its journal entries.
+        """
+        statements = self.statements(cls)
+        if path.exists(cls.file_path()):
+            with open(cls.file_path(), 'r') as f:
+                conn.executemany(statements['save'], (
+                    save_params(cls, obj_id, raw, obj_json)
+                    for obj_id, raw, obj_json in iter_json_items(f)))
+        for replay_path in replay_paths:
+            with open(replay_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry['op'] == 'save':
+                        conn.execute(statements['save'], save_params(
+                            cls, entry['id'], json.dumps(entry['obj']),
+                            entry['obj']))
+                    else:
+                        conn.execute(statements['remove'], (entry['id'],))
+
+    def save(self, obj: TypeVar('Base')):
+        """
+        Store an object.
+        """
+        cls = obj.__class__
+        values = {
+            attr: getattr(obj, attr, None) for attr in cls.INDEXED_ATTRIBUTES
+        }
+        self.connection().execute(self.statements(cls)['save'], save_params(
+            cls, obj.id, json.dumps(obj.to_json(True)), values))
+
+    def remove(self, obj: TypeVar('Base')):
+        """
+        Drop an object.
+        """
+        self.connection().execute(
+            self.statements(obj.__class__)['remove'], (obj.id,))
+
+    def count(self, cls) -> int:
+        """
+        Count the objects of a class.
+        """
+        return self.connection().execute(
+            self.statements(cls)['count'], (cls.__name__,)).fetchone()[0]
+
+    def get(self, cls, obj_id: str) -> TypeVar('Base'):
+        """
+        Return one object of a class by ID, or None.
+        """
+        row = self.connection().execute(
+            self.statements(cls)['get'], (obj_id,)).fetchone()
+        if row is None:
+            return None
+        return cls(**json.loads(row[0]))
+
+    def search(self, cls, attributes: dict) -> List[TypeVar('Base')]:
+        """
+        Return the objects of a class with matching attributes.
+        Scalar values of indexed attributes, and of the other slots, are
+        matched in SQL; the objects are checked once more in Python so
+        the results are the same as with the file storage.
+        """
+        slots = cls.slot_names()
+        where = []
+        params = []
+        for k, v in attributes.items():
+            if v is not None and not isinstance(v, (str, int, float)):
+                continue
+            if k in cls.INDEXED_ATTRIBUTES:
+                column = quote(k)
+            elif k in slots and k[0] != '_':
+                column = 'json_extract(data, ?)'
+                params.append('$.' + k)
+            else:
+                continue
+            if v is None:
+                where.append('{} IS NULL'.format(column))
+            else:
+                where.append('{} = ?'.format(column))
+                params.append(v)
+        sql = self.statements(cls)['select']
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        def _search(obj):
+            for k, v in attributes.items():
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        objs = (cls(**json.loads(row[0]))
+                for row in self.connection().execute(sql, params))
+        return list(filter(_search, objs))
@@ -10,6 +10,9 @@ class UserSession(Base):
     UserSession model that inherits from Base.
     This model stores user session information in a persistent way.
     """
+    INDEXED_ATTRIBUTES = ('session_id',)
+    __slots__ = ('user_id', 'session_id')
+
     def __init__(self, *args: list, **kwargs: dict):
         """
         Initializes a User session instance.
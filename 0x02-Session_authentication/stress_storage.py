@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test of the model storage: writer threads create,
+update and remove users while reader threads search and count them,
+then the store is reloaded and checked for lost updates.
+The storage runs in the mode set by the MODELS_* variables.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import List
+
+from models import base
+from models.user import User
+
+
+def writer(k: int, count: int, rounds: int, errors: List):
+    """
+    Creates count users, saves each one rounds more times with a new
+    first_name, then removes every fifth one.
+    """
+    try:
+        users = []
+        for i in range(count):
+            user = User(email='{}-{}@example.com'.format(k, i))
+            user.first_name = '0'
+            user.save()
+            users.append(user)
+        for r in range(1, rounds + 1):
+            for user in users:
+                user.first_name = str(r)
+                user.save()
+        for user in users[::5]:
+            user.remove()
+    except Exception as e:
+        errors.append(e)
+
+
+def reader(done: threading.Event, reads: List[int], errors: List):
+    """
+    Searches and counts users until done is set.
+    """
+    while not done.is_set():
+        try:
+            User.search({'email': '0-0@example.com'})
+            User.count()
+            User.all()
+            reads[0] += 1
+        except Exception as e:
+            errors.append(e)
+
+
+def check(expected: int, rounds: int) -> List[str]:
+    """
+    Returns what is wrong with the users found in the storage.
+    """
+    problems = []
+    users = User.all()
+    if User.count() != expected or len(users) != expected:
+        problems.append('{} users counted, {} listed, {} expected'.format(
+            User.count(), len(users), expected))
+    stale = [u.email for u in users if u.first_name != str(rounds)]
+    if stale:
+        problems.append('{} users lost an update, like {}'.format(
+            len(stale), stale[0]))
+    missing = [u.email for u in users
+               if len(User.search({'email': u.email})) != 1]
+    if missing:
+        problems.append('{} users not found by email, like {}'.format(
+            len(missing), missing[0]))
+    return problems
+
+
+def main():
+    """
+    Runs the threads, checks the store before and after a reload and
+    exits with status 1 on any problem.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--writers", type=int, default=8,
+                        help="writer threads")
+    parser.add_argument("--readers", type=int, default=4,
+                        help="reader threads")
+    parser.add_argument("--users", type=int, default=30,
+                        help="users created by each writer")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="updates of each user")
+    args = parser.parse_args()
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix="models_stress_")
+    os.chdir(tmp_dir)
+    try:
+        User.load_from_file()
+        errors = []
+        reads = [0]
+        done = threading.Event()
+        readers = [threading.Thread(target=reader, args=(done, reads, errors))
+                   for _ in range(args.readers)]
+        writers = [threading.Thread(target=writer, args=(
+            k, args.users, args.rounds, errors))
+            for k in range(args.writers)]
+        start = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        base.flush_dirty()
+        elapsed = time.perf_counter() - start
+        expected = args.writers * (args.users - (args.users + 4) // 5)
+        problems = ['{}: {}'.format(type(e).__name__, e) for e in errors]
+        problems += check(expected, args.rounds)
+        User.load_from_file()
+        problems += ['after reload: ' + p for p in check(expected,
+                                                         args.rounds)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    print("{} users, {} reads in {:.1f}s".format(expected, reads[0], elapsed))
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()